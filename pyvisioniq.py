@@ -1,10 +1,15 @@
 '''This script can be used to collect, export to prom and view the data here'''
 import time
 import os
+import atexit
+import csv
 import io
 import sys
-from datetime import datetime, timedelta
-from threading import Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from apscheduler.schedulers.background import BackgroundScheduler
 from hyundai_kia_connect_api import VehicleManager
 from hyundai_kia_connect_api.exceptions import (
     AuthenticationError,
@@ -17,14 +22,14 @@ from hyundai_kia_connect_api.exceptions import (
     InvalidAPIResponseError,
 )
 from flask import Flask, render_template, Response
-from prometheus_client import Gauge, generate_latest
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import pandas as pd
-import folium
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
+import matplotlib
 from dotenv import load_dotenv
 
+# Headless rendering only; never initialise an interactive backend. pandas, folium and the rest of
+# matplotlib are imported inside the functions that use them to keep start-up fast.
+matplotlib.use('Agg')
+
 load_dotenv()
 
 REQUIRED_ENV_VARS = ["BLUELINKUSER", "BLUELINKPASS", "BLUELINKPIN",
@@ -49,6 +54,23 @@ APILIMIT = int(os.getenv("BLUELINKLIMIT", "30")) # Max API requests per 24 hours
 PORT = int(os.getenv("BLUELINKPORT", "8001"))
 HOST = os.getenv("BLUELINKHOST", '0.0.0.0')
 CSV_FILE = os.getenv("BLUELINKCSV", './vehicle_data.csv')
+MAX_ROWS = int(os.getenv("BLUELINKMAXROWS", "10000")) # Most recent rows to load, 0 for all
+
+# Column order of the CSV log
+CSV_COLUMNS = ['Timestamp', 'Charging Level', 'Mileage', 'Battery Health',
+               'EV Driving Range', 'Longitude', 'Latitude']
+
+# Columns read back for the plots and the map; battery health is only exported to Prometheus
+READ_COLUMNS = ['Timestamp', 'Charging Level', 'Mileage', 'EV Driving Range', 'Longitude', 'Latitude']
+
+# Numeric column types used when reading the log; odometer and coordinates need double precision
+CSV_DTYPES = {
+    'Charging Level': 'float32',
+    'Mileage': 'float64',
+    'EV Driving Range': 'float32',
+    'Longitude': 'float64',
+    'Latitude': 'float64',
+}
 
 vm = VehicleManager(region=int(REGION),
                     brand=int(BRAND),
@@ -59,17 +81,130 @@ vm = VehicleManager(region=int(REGION),
 # Initialize Flask app
 app = Flask(__name__)
 
-# Prometheus metrics
-charging_level_gauge = Gauge('vehicle_data_charging_level', 'Charging level')
-mileage_gauge = Gauge('vehicle_data_mileage', 'Mileage')
-battery_health_gauge = Gauge('vehicle_data_battery_health', 'Battery health percentage')
-ev_driving_range_gauge = Gauge('vehicle_data_ev_driving_range', 'Estimated driving range')
+# Prometheus metrics, kept in their own registry so the exposition only changes on update
+registry = CollectorRegistry()
+charging_level_gauge = Gauge('vehicle_data_charging_level', 'Charging level', registry=registry)
+mileage_gauge = Gauge('vehicle_data_mileage', 'Mileage', registry=registry)
+battery_health_gauge = Gauge('vehicle_data_battery_health', 'Battery health percentage', registry=registry)
+ev_driving_range_gauge = Gauge('vehicle_data_ev_driving_range', 'Estimated driving range', registry=registry)
+
+# Serialized metrics served by /metrics, regenerated after each update
+_metrics_cache = {'text': generate_latest(registry)}
+
+# Plots with more points than this are averaged into time buckets before drawing
+MAX_PLOT_POINTS = 1000
+
+class TokenBucket:  # pylint: disable=too-few-public-methods
+    '''Token bucket rate limiter shared by every caller of the vehicle API.'''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate  # Tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        '''Take a token, sleeping until one is available.'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now so concurrent callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        time.sleep(wait)
 
 # Rate limit variables
 interval_between_requests = timedelta(seconds=86400 // APILIMIT)
+api_bucket = TokenBucket(rate=1 / interval_between_requests.total_seconds(), capacity=1)
+
+# Parsed CSV cache, keyed on the file's (mtime, size) so it is only re-read after an update
+_df_cache = {'stat': None, 'df': None}
+_df_lock = Lock()
+
+# Rendered map HTML, keyed the same way as the DataFrame cache
+_map_cache = {'stat': None, 'html': ''}
+
+# Rendered PNG bytes for every plot, produced together from one load of the data
+_png_cache = {'stat': None, 'pngs': {}}
+_png_lock = Lock()
+
+# One Figure/Axes pair per plot, cleared and redrawn on each render; each has a lock as figures are not thread-safe
+_figs = {}
+
+# Held while a vehicle update runs so concurrent callers share one API request
+_update_lock = Lock()
+
+# Append handle for the CSV log, opened on first write and kept for the life of the process
+_csv_log = {'file': None, 'writer': None}
+
+def csv_stat():
+    '''Return a cheap (mtime, size) fingerprint of the CSV file used as a cache key.'''
+    stat = os.stat(CSV_FILE)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def get_data():
+    '''Return the logged vehicle data indexed by timestamp, re-parsing the CSV only when it changes.'''
+    # pylint: disable=import-outside-toplevel
+    import pandas as pd
+
+    key = csv_stat()
+    with _df_lock:
+        if _df_cache['stat'] != key:
+            # Only keep the tail of the log so memory stays bounded as it grows
+            with open(CSV_FILE, 'rb') as csv_file:
+                header = csv_file.readline()
+                rows = deque(csv_file, maxlen=MAX_ROWS or None)
+
+            # Parse with Arrow's multithreaded CSV reader
+            data = pd.read_csv(io.BytesIO(header + b''.join(rows)), engine='pyarrow',
+                               usecols=READ_COLUMNS, dtype=CSV_DTYPES)
+
+            # Ensure the 'Timestamp' column is correctly parsed as datetime
+            data['Timestamp'] = pd.to_datetime(data['Timestamp'], errors='coerce', cache=True)
+
+            # Set 'Timestamp' as the index
+            data.set_index('Timestamp', inplace=True)
+            _df_cache['df'] = data
+            _df_cache['stat'] = key
+        return _df_cache['df']
+
+def append_row(row):
+    '''Append a row to the CSV log, writing the header first if the file is new.'''
+    if _csv_log['file'] is None:
+        csv_file = open(CSV_FILE, 'a', buffering=1, newline='', encoding='utf-8')  # pylint: disable=consider-using-with
+        atexit.register(csv_file.close)
+        _csv_log['file'] = csv_file
+        _csv_log['writer'] = csv.writer(csv_file, lineterminator=os.linesep)
+        if csv_file.tell() == 0:
+            _csv_log['writer'].writerow(CSV_COLUMNS)
+    _csv_log['writer'].writerow(row)
+    _csv_log['file'].flush()
+
+def invalidate_caches():
+    '''Drop every cached parse and render so the next request picks up new data.'''
+    with _df_lock:
+        _df_cache['stat'] = None
+    _map_cache['stat'] = None
+    with _png_lock:
+        _png_cache['stat'] = None
 
 def fetch_and_update_metrics():
+    '''Fetch data from the vehicle API and update Prometheus metrics, coalescing concurrent calls.'''
+    if not _update_lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+        # An update is already in flight; wait for it rather than spending another API request
+        with _update_lock:
+            return
+    try:
+        _fetch_and_update_metrics()
+    finally:
+        _update_lock.release()
+
+def _fetch_and_update_metrics():
     '''Fetch data from the vehicle API and update Prometheus metrics.'''
+    api_bucket.acquire()
+
     # Refresh the token and update vehicle data
     vehicle = None
     # pylint: disable=broad-exception-caught
@@ -102,7 +237,9 @@ def fetch_and_update_metrics():
     #     print(f"Unexpected error: {general_error}. Check library or API documentation.", file=sys.stderr)
 
 
-    if vehicle is None or vehicle.last_updated_at < datetime.now() - interval_between_requests:
+    # The API reports last_updated_at as an aware datetime, so compare against an aware "now"
+    now_utc = datetime.now(timezone.utc)
+    if vehicle is None or vehicle.last_updated_at < now_utc - interval_between_requests:
         print("Cached data is stale, force refreshing...", file=sys.stderr)
         vm.force_refresh_vehicle_state(VEHICLE_ID)
         vehicle = vm.get_vehicle(VEHICLE_ID)  # Get updated vehicle data
@@ -125,169 +262,180 @@ def fetch_and_update_metrics():
     mileage_gauge.set(mileage)
     battery_health_gauge.set(battery_health)
     ev_driving_range_gauge.set(ev_driving_range)
+    _metrics_cache['text'] = generate_latest(registry)
 
-    data_to_log = pd.DataFrame({
-        'Timestamp': [datetime.now().isoformat()],
-        'Charging Level': [charging_level],
-        'Mileage': [mileage],
-        'Battery Health': [battery_health],
-        'EV Driving Range': [ev_driving_range],
-        'Longitude': [longitude],
-        'Latitude': [latitude]
-    })
-
-    # Write to CSV with header only if it's the first time
-    if not os.path.exists(CSV_FILE):
-        data_to_log.to_csv(CSV_FILE, index=False)
-    else:
-        data_to_log.to_csv(CSV_FILE, mode='a', header=False, index=False)
+    # The log keeps naive local timestamps, matching the rows already written
+    timestamp = now_utc.astimezone().replace(tzinfo=None).isoformat()
+    data_to_log = [timestamp, charging_level, mileage, battery_health,
+                   ev_driving_range, longitude, latitude]
+
+    append_row(data_to_log)
 
-    print(f"{datetime.now().isoformat()}," +
+    invalidate_caches()
+    render_pngs()  # Pre-render the plots so requests are served straight from the cache
+
+    print(f"{timestamp}," +
           f"Charging Level: {charging_level}%, " +
           f"Mileage: {mileage} miles, " +
           f"Battery Health: {battery_health}%," +
           f"EV Driving Range: {ev_driving_range} miles," +
           f"long: {longitude}, lat: {latitude}", file=sys.stderr)
 
-def scheduled_update():
-    '''Schedule periodic updates to fetch and
-        update vehicle data while adhering to the API rate limits.'''
-    while True:
-        now = datetime.now()
-        next_update = (now + interval_between_requests).replace(second=0, microsecond=0)
-        fetch_and_update_metrics()
-        sleep_duration = (next_update - datetime.now()).total_seconds()
-        time.sleep(max(0, sleep_duration))
-
-def rangeplot():
-    '''Generate a plot of the charging level over time.'''
-    data = pd.read_csv(CSV_FILE)  # Load data directly from CSV using Pandas
-
-    # Ensure the 'Timestamp' column is correctly parsed as datetime
-    data['Timestamp'] = pd.to_datetime(data['Timestamp'], errors='coerce')
-
-    # Set 'Timestamp' as the index
-    data.set_index('Timestamp', inplace=True)
-
-    plt.figure(figsize=(10, 6))
-    plt.plot(data.index, data['EV Driving Range'], label='EV Driving Range', marker='o', linestyle='-')
-    plt.xlabel('Timestamp')
-    plt.ylabel('Miles')
-    plt.title('EV Driving Range Over Time')
-    plt.legend()
-    plt.xticks(rotation=45, ha="right")
-
-    # Set the major locator to a reasonable interval
-    plt.gca().xaxis.set_major_locator(mdates.AutoDateLocator())
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%m/%d/%y %H:%M'))
-    plt.tight_layout()  # Adjust the layout to prevent clipping
-
-    plt.grid(axis='y')
-    fig = plt.gcf()
-    plt.close()
-    return fig
-
-def chargeplot():
-    '''Generate a plot of the charging level over time.'''
-    data = pd.read_csv(CSV_FILE)  # Load data directly from CSV using Pandas
-
-    # Ensure the 'Timestamp' column is correctly parsed as datetime
-    data['Timestamp'] = pd.to_datetime(data['Timestamp'], errors='coerce')
-
-    # Set 'Timestamp' as the index
-    data.set_index('Timestamp', inplace=True)
-    plt.figure(figsize=(10, 6))
-    plt.plot(data.index, data['Charging Level'], label='Charging Level', marker='o', linestyle='-')
-    plt.xlabel('Timestamp')
-    plt.ylabel('%')
-    plt.title('Charging Level Over Time')
-    plt.legend()
-    plt.xticks(rotation=45, ha="right")
-
-    # Set the major locator to a reasonable interval
-    plt.gca().xaxis.set_major_locator(mdates.AutoDateLocator())
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%m/%d/%y %H:%M'))
-    plt.tight_layout()  # Adjust the layout to prevent clipping
-
-    plt.grid(axis='y')
-    fig = plt.gcf()
-    plt.close()
-    return fig
-
-def mileageplot():
-    '''Generate a plot of the mileage over time.'''
-    data = pd.read_csv(CSV_FILE)  # Load data directly from CSV using Pandas
-
-    # Ensure the 'Timestamp' column is correctly parsed as datetime
-    data['Timestamp'] = pd.to_datetime(data['Timestamp'], errors='coerce')
-
-    # Set 'Timestamp' as the index
-    data.set_index('Timestamp', inplace=True)
-    plt.figure(figsize=(10,6))
-    plt.plot(data.index, data['Mileage'], label='Mileage', marker='x', linestyle='-')
-    plt.xlabel('Timestamp')
-    plt.ylabel('Miles')
-    plt.title('Total Miles')
-    plt.legend()
-    plt.xticks(rotation=45, ha="right")
-
-    # Set the major locator to a reasonable interval
-    plt.gca().xaxis.set_major_locator(mdates.AutoDateLocator())
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%m/%d/%y %H:%M'))
-    plt.tight_layout()  # Adjust the layout to prevent clipping
-
-    plt.grid(axis='y')
-    fig = plt.gcf()
-    plt.close()
-    return fig
+def downsample(series):
+    '''Average a time-indexed series into at most MAX_PLOT_POINTS evenly sized time buckets.'''
+    # pylint: disable=import-outside-toplevel
+    import pandas as pd
+
+    if len(series) <= MAX_PLOT_POINTS:
+        return series
+
+    series = series[series.index.notna()]
+    span = series.index.max() - series.index.min()
+    bucket = max((span / MAX_PLOT_POINTS).ceil('s'), pd.Timedelta(seconds=1))
+    return series.resample(bucket).mean().dropna()
+
+def get_figure(key):
+    '''Return the reusable (figure, axes, lock) for a plot, creating it on first use.'''
+    # pylint: disable=import-outside-toplevel
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    if key not in _figs:
+        fig = Figure(figsize=(10, 6))
+        FigureCanvas(fig)
+        _figs.setdefault(key, (fig, fig.add_subplot(), Lock()))
+    return _figs[key]
+
+def timeseries_png(data, column, ylabel, title, marker='o'):
+    '''Render a plot of a logged column over time to PNG bytes.'''
+    # pylint: disable=import-outside-toplevel
+    import matplotlib.dates as mdates
+    from matplotlib.figure import SubplotParams
+
+    series = downsample(data[column])
+
+    fig, ax, lock = get_figure(column)
+    with lock:
+        # Start from the default layout so tight_layout does not depend on the previous render
+        ax.cla()
+        defaults = SubplotParams()
+        fig.subplots_adjust(left=defaults.left, bottom=defaults.bottom, right=defaults.right, top=defaults.top)
+        ax.plot(series.index, series, label=column, marker=marker, linestyle='-')
+        ax.set_xlabel('Timestamp')
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+        ax.legend()
+
+        # Set the major locator to a reasonable interval
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d/%y %H:%M'))
+        for label in ax.get_xticklabels():
+            label.set(rotation=45, ha="right")
+        fig.tight_layout()  # Adjust the layout to prevent clipping
+
+        ax.grid(axis='y')
+        output = io.BytesIO()
+        fig.canvas.print_png(output)
+    return output.getvalue()
+
+def rangeplot(data):
+    '''Generate a PNG plot of the EV driving range over time.'''
+    return timeseries_png(data, 'EV Driving Range', 'Miles', 'EV Driving Range Over Time')
+
+def chargeplot(data):
+    '''Generate a PNG plot of the charging level over time.'''
+    return timeseries_png(data, 'Charging Level', '%', 'Charging Level Over Time')
+
+def mileageplot(data):
+    '''Generate a PNG plot of the mileage over time.'''
+    return timeseries_png(data, 'Mileage', 'Miles', 'Total Miles', marker='x')
+
+# Plots served as PNGs, keyed by the name used in their endpoint
+PLOTS = {
+    'mileage': mileageplot,
+    'range': rangeplot,
+    'charge': chargeplot,
+}
 
 def mapit():
-    '''Create and save a map visualization of the vehicle's location data.'''
-    data = pd.read_csv(CSV_FILE)  # Load data directly from CSV using Pandas
-    # data['Timestamp'] = pd.to_datetime(data['Timestamp'])
+    '''Create a map visualization of the vehicle's location data, reusing the last render if unchanged.'''
+    key = csv_stat()
+    if _map_cache['stat'] == key:
+        return _map_cache['html']
+
+    # pylint: disable=import-outside-toplevel
+    import folium
+
+    data = get_data().dropna(subset=['Latitude', 'Longitude'])
     map_center = [data['Latitude'].mean(), data['Longitude'].mean()]
     my_map = folium.Map(location=map_center, zoom_start=12)
 
-    for _, row in data.iterrows():
-        folium.CircleMarker(
-            location=[row['Latitude'], row['Longitude']],
+    latitudes = data['Latitude'].to_numpy()
+    longitudes = data['Longitude'].to_numpy()
+    charging_levels = data['Charging Level'].to_numpy()
+    mileages = data['Mileage'].to_numpy()
+
+    # Ship every point as a single GeoJSON layer instead of one map child (and template render) per marker
+    features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [float(longitude), float(latitude)]},
+            'properties': {'popup': f"Charging Level: {charging_level}%, Mileage: {mileage} miles"},
+        }
+        for latitude, longitude, charging_level, mileage in zip(latitudes, longitudes, charging_levels, mileages)
+    ]
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        marker=folium.CircleMarker(
             radius=5,
             color="blue",
             fill=True,
             fill_color="blue",
             fill_opacity=0.7,
-            popup=f"Charging Level: {row['Charging Level']}%, Mileage: {row['Mileage']} miles"
-        ).add_to(my_map)
+        ),
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False),
+    ).add_to(my_map)
 
     # my_map.save("ev_map.html")
-    return my_map.render()
+    html = my_map.get_root().render()
+    _map_cache['html'] = html
+    _map_cache['stat'] = key
+    return html
+
+def render_pngs():
+    '''Return the PNG bytes of every plot, re-rendering them in parallel when the CSV has changed.'''
+    key = csv_stat()
+    with _png_lock:
+        if _png_cache['stat'] != key:
+            data = get_data()
+            # Agg releases the GIL while rasterizing, so the plots render concurrently
+            with ThreadPoolExecutor(max_workers=len(PLOTS)) as pool:
+                futures = {name: pool.submit(plot, data) for name, plot in PLOTS.items()}
+            _png_cache['pngs'] = {name: future.result() for name, future in futures.items()}
+            _png_cache['stat'] = key
+        return _png_cache['pngs']
+
+def render_png(name):
+    '''Return the PNG bytes for a single plot.'''
+    return render_pngs()[name]
 
 def mileage_png():
     '''Generate and return a PNG image of the mileage plot.'''
-    fig = mileageplot()
-    output = io.BytesIO()
-    FigureCanvas(fig).print_png(output)
-    return Response(output.getvalue(), mimetype='image/png')
+    return Response(render_png('mileage'), mimetype='image/png')
 
 def range_png():
     '''Generate and return a PNG image of the range level plot.'''
-    fig = rangeplot()
-    output = io.BytesIO()
-    FigureCanvas(fig).print_png(output)
-    return Response(output.getvalue(), mimetype='image/png')
+    return Response(render_png('range'), mimetype='image/png')
 
 def charge_png():
     '''Generate and return a PNG image of the charging level plot.'''
-    fig = chargeplot()
-    output = io.BytesIO()
-    FigureCanvas(fig).print_png(output)
-    return Response(output.getvalue(), mimetype='image/png')
+    return Response(render_png('charge'), mimetype='image/png')
 
 # Update Flask routes
 @app.route('/metrics')
 def metrics():
     '''Endpoint to expose Prometheus metrics.'''
-    return Response(generate_latest(), mimetype='text/plain')
+    return Response(_metrics_cache['text'], mimetype='text/plain')
 
 @app.route('/map')
 def endpointmap():
@@ -311,10 +459,12 @@ def endpointcharge():
 
 if __name__ == "__main__":
     if UPDATE:
-    # Start the scheduled update in a separate thread
-        update_thread = Thread(target=scheduled_update)
-        update_thread.daemon = True
-        update_thread.start()
+        # Fetch now, then at a fixed interval that adheres to the API rate limits
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(fetch_and_update_metrics, 'interval',
+                          seconds=interval_between_requests.total_seconds(),
+                          next_run_time=datetime.now())
+        scheduler.start()
     else:
         print("Not updating.")
 